@@ -5,37 +5,51 @@ import time
 import threading
 import signal # To handle Ctrl+C gracefully with the spinner
 import atexit # To ensure screen restoration on exit
-import io # For suppressing output
 import os # For managing environment variables
+import re # For spotting the end of the thinking block
+import hashlib # For keying the weight cache
+import shutil # For writing/removing weight cache entries
 
 DEFAULT_MODEL_PATH = "mark-arts/qwen3-30b-a3b-DWQ-3bit-gs128"
 DEFAULT_MAX_TOKENS = 16000 # Increased default max tokens
 DEFAULT_TEMP = 0.6
 DEFAULT_SEED = 0
+DEFAULT_CONTEXT = 32768 # Prompt + response token budget; older turns are dropped beyond this
 REPLACEMENT_CHAR = "\ufffd" # Standard Unicode replacement character
-
-# ANSI escape codes for alternate screen buffer
-ENTER_ALT_SCREEN = "\x1b[?1049h"
-EXIT_ALT_SCREEN = "\x1b[?1049l"
-CLEAR_SCREEN = "\x1b[2J"
-CURSOR_TO_HOME = "\x1b[H"
+DETOKENIZE_BATCH = 4 # Generated tokens decoded to text at a time while streaming
+THINK_END_TAG = "</think>"
+# Closing tag plus the blank line(s) that usually separate it from the answer
+_THINK_END = re.compile(re.escape(THINK_END_TAG) + r"\n{0,2}")
+
+# ANSI escape codes for alternate screen buffer (bytes, written via write_raw)
+ENTER_ALT_SCREEN = b"\x1b[?1049h"
+EXIT_ALT_SCREEN = b"\x1b[?1049l"
+CLEAR_SCREEN = b"\x1b[2J"
+CURSOR_TO_HOME = b"\x1b[H"
+CLEAR_LINE = b"\x1b[2K"
 
 # Flag to track if alternate screen is active
 alt_screen_active = False
 
+def write_raw(data):
+    """Writes pre-encoded bytes to the terminal, skipping the text layer's encoding."""
+    sys.stdout.flush() # Keep ordering with anything still buffered as text
+    sys.stdout.buffer.write(data)
+    sys.stdout.buffer.flush()
+
 def enter_alternate_screen():
     """Enters the alternate screen buffer and clears it."""
     global alt_screen_active
     if not alt_screen_active:
         # Enter alt screen, clear it, move cursor to top-left
-        print(ENTER_ALT_SCREEN + CLEAR_SCREEN + CURSOR_TO_HOME, end="", flush=True)
+        write_raw(ENTER_ALT_SCREEN + CLEAR_SCREEN + CURSOR_TO_HOME)
         alt_screen_active = True
 
 def exit_alternate_screen():
     """Exits the alternate screen buffer."""
     global alt_screen_active
     if alt_screen_active:
-        print(EXIT_ALT_SCREEN, end="", flush=True)
+        write_raw(EXIT_ALT_SCREEN)
         alt_screen_active = False
 
 # Register exit_alternate_screen to be called automatically on script exit
@@ -43,50 +57,108 @@ def exit_alternate_screen():
 atexit.register(exit_alternate_screen)
 
 class Spinner:
-    """Simple CLI spinner running in a separate thread."""
-    def __init__(self, message="Thinking..."):
+    """Simple CLI spinner advanced inline by the generation loop (no background thread)."""
+    def __init__(self, message="Thinking...", interval=0.15):
         self.message = message
         # self.symbols = ['|', '/', '-', '\']
         self.symbols = ['◢', '◣', '◤', '◥'] # Alternative spinner characters
-        self.running = False
-        self.thread = None
-        self.lock = threading.Lock() # Protect access to running flag
-
-    def _spin(self):
-        i = 0
-        while True:
-            with self.lock:
-                if not self.running:
-                    break
-            # Write spinner frame
-            # Use \r to return to beginning of line, works in alt screen
-            sys.stdout.write(f"\r{self.message} {self.symbols[i % len(self.symbols)]}")
-            sys.stdout.flush()
-            time.sleep(0.15) # Spinner speed
-            i += 1
-        # Clear the spinner line upon stopping using \r
-        sys.stdout.write('\r' + ' ' * (len(self.message) + 5) + '\r')
+        self.interval = interval # Minimum seconds between frames
+        self.index = 0
+        self.last_update = 0.0
+        self.active = False
+
+    def _draw(self):
+        # Use \r to return to beginning of line, works in alt screen
+        sys.stdout.write(f"\r{self.message} {self.symbols[self.index % len(self.symbols)]}")
         sys.stdout.flush()
+        self.index += 1
+        self.last_update = time.monotonic()
 
     def start(self):
-        """Start the spinner in a background thread."""
-        with self.lock:
-            if not self.running:
-                self.running = True
-                self.thread = threading.Thread(target=self._spin, daemon=True)
-                self.thread.start()
+        """Show the spinner's first frame."""
+        if not self.active:
+            self.active = True
+            self._draw()
+
+    def tick(self):
+        """Advance the spinner if at least `interval` seconds have passed since the last frame."""
+        if self.active and time.monotonic() - self.last_update >= self.interval:
+            self._draw()
 
     def stop(self):
-        """Stop the spinner and wait for the thread to finish."""
-        needs_join = False
-        with self.lock:
-            if self.running:
-                self.running = False
-                needs_join = True
-        if needs_join and self.thread:
-            # Wait briefly for the thread to exit to avoid blocking
-            self.thread.join(timeout=0.5)
-            self.thread = None
+        """Clear the spinner line."""
+        if self.active:
+            self.active = False
+            sys.stdout.write('\r' + ' ' * (len(self.message) + 5) + '\r')
+            sys.stdout.flush()
+
+
+class StreamWriter:
+    """Coalesces streamed text and writes it once enough has built up or enough time has passed."""
+    def __init__(self, max_chars=64, max_delay=0.030):
+        self.max_chars = max_chars
+        self.max_delay = max_delay # Seconds
+        self.buf = []
+        self.n = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, text):
+        self.buf.append(text)
+        self.n += len(text)
+        now = time.monotonic()
+        if self.n >= self.max_chars or now - self.last_flush > self.max_delay:
+            self._flush(now)
+
+    def drain(self):
+        """Write out anything still buffered."""
+        if self.buf:
+            self._flush(time.monotonic())
+
+    def _flush(self, now):
+        sys.stdout.write("".join(self.buf))
+        sys.stdout.flush()
+        self.buf.clear()
+        self.n = 0
+        self.last_flush = now
+
+
+def stream_text(model, tokenizer, prompt, token_ids, batch_size=DETOKENIZE_BATCH, **kwargs):
+    """Generates from `prompt`, yielding decoded text once every `batch_size` tokens.
+
+    Each batch costs one pair of tokenizer.decode calls instead of per-token detokenizer
+    work: the window decoded starts at the previous batch, so merges and leading spaces
+    come out as in a full decode, and only the text past the previous batch is yielded.
+    A batch ending in an incomplete UTF-8 sequence is held back until more tokens arrive.
+    Every generated token id (including a final EOS, which has also been run through the
+    model) is appended to `token_ids`. Extra keyword arguments go to generate_step.
+    """
+    from mlx_lm.generate import generate_step, wired_limit, generation_stream
+
+    generated = [] # Generated ids, excluding EOS
+    prefix_offset = 0 # Start of the decode window
+    read_offset = 0 # End of the ids whose text has been yielded
+
+    def decode_new(final):
+        nonlocal prefix_offset, read_offset
+        prefix_text = tokenizer.decode(generated[prefix_offset:read_offset], clean_up_tokenization_spaces=False)
+        text = tokenizer.decode(generated[prefix_offset:], clean_up_tokenization_spaces=False)
+        if text.endswith(REPLACEMENT_CHAR) and not final:
+            return "" # Incomplete multi-byte character, wait for the next token
+        prefix_offset, read_offset = read_offset, len(generated)
+        return text[len(prefix_text):]
+
+    with wired_limit(model, [generation_stream]):
+        for token, _ in generate_step(prompt, model, **kwargs):
+            token_ids.append(token)
+            if token in tokenizer.eos_token_ids:
+                break
+            generated.append(token)
+            if len(generated) - read_offset >= batch_size:
+                text = decode_new(final=False)
+                if text:
+                    yield text
+    if len(generated) > read_offset:
+        yield decode_new(final=True)
 
 
 # Global spinner instance to allow signal handler to stop it
@@ -104,13 +176,96 @@ def signal_handler(sig, frame):
 signal.signal(signal.SIGINT, signal_handler)
 
 
+# --- Optional on-disk cache of the processed model weights ---
+# An entry is a self-contained MLX model directory: the original config/tokenizer files
+# plus all weights, as loaded, in one safetensors file. Loading an entry never touches the
+# original checkpoint or the Hugging Face Hub, which is where it saves time: Hub models skip
+# the snapshot_download round-trip and sharded or unconverted checkpoints are read as one
+# file. For a local, already-converted MLX model there is little to gain.
+WEIGHT_CACHE_FILE = "model.safetensors"
+
+def resolve_local_model_dir(model_path):
+    """Returns the local directory holding `model_path` without using the network, or None."""
+    if os.path.isdir(model_path):
+        return model_path
+    from huggingface_hub import try_to_load_from_cache
+    config_file = try_to_load_from_cache(model_path, "config.json")
+    return os.path.dirname(config_file) if isinstance(config_file, str) else None
+
+def weight_cache_entry(model_path, cache_dir):
+    """Returns the cache entry directory for `model_path`, or None if it can't be keyed yet.
+
+    Entries are keyed by the resolved model directory, its mtime and the mlx_lm version.
+    Hub snapshots live in per-commit directories, so a new revision gets a new entry.
+    """
+    try:
+        import mlx_lm
+        model_dir = resolve_local_model_dir(model_path)
+        if model_dir is None:
+            return None # Not downloaded yet
+        model_dir = os.path.realpath(model_dir)
+        key_source = model_dir + str(os.path.getmtime(model_dir)) + mlx_lm.__version__
+    except Exception:
+        return None # The cache is optional; never let keying stop the model from loading
+    key = hashlib.sha1(key_source.encode()).hexdigest()
+    return os.path.join(os.path.expanduser(cache_dir), key)
+
+def load_weight_cache(entry_dir):
+    """Loads the model and tokenizer from a cache entry, or returns None if it is missing or unusable."""
+    from mlx_lm.utils import load
+
+    if not os.path.isdir(entry_dir):
+        return None
+    try:
+        return load(entry_dir)
+    except Exception:
+        # Stale or corrupt entry: drop it so it gets rebuilt from the original model
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        return None
+
+def save_weight_cache(model, model_dir, entry_dir):
+    """Writes `model`'s weights and the non-weight files of `model_dir` as a cache entry.
+
+    Returns False if the entry could not be written (e.g. disk full or read-only directory).
+    """
+    import mlx.core as mx
+    from mlx.utils import tree_flatten
+
+    # Build the entry under a temporary name so an interrupted save never leaves a bad entry
+    tmp_dir = entry_dir + ".tmp"
+    try:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in os.listdir(model_dir):
+            src = os.path.join(model_dir, name)
+            # The original shards and their index are replaced by the single weights file
+            if os.path.isfile(src) and not name.endswith(".safetensors") and name != "model.safetensors.index.json":
+                shutil.copy2(src, tmp_dir)
+        mx.save_safetensors(
+            os.path.join(tmp_dir, WEIGHT_CACHE_FILE),
+            dict(tree_flatten(model.parameters())),
+            metadata={"format": "mlx"},
+        )
+        os.replace(tmp_dir, entry_dir)
+        return True
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return False
+
+
 # --- Function to load model in a separate thread and suppress output ---
 def load_model_threaded_and_quietly(args, result_container):
     """Loads the model and tokenizer in a separate thread, suppressing stdout."""
     # --- Delayed Imports (for the thread) ---
+    # Everything the chat loop needs is imported here too, so the MLX import cost
+    # overlaps the header animation; the later imports in main_cli are then cache hits.
     import mlx.core as mx
     # import mlx.nn as nn # Not strictly needed for load, but often related
     from mlx_lm.utils import load
+    # Warm-up only: these are used by the chat loop
+    import mlx_lm.generate
+    import mlx_lm.sample_utils
+    import mlx_lm.models.cache
 
     original_stdout_fd = sys.stdout.fileno()
     original_stderr_fd = sys.stderr.fileno()
@@ -128,6 +283,7 @@ def load_model_threaded_and_quietly(args, result_container):
     model = None
     tokenizer = None
     error = None
+    cache_entry = None # Weight cache entry still to be written, if any
 
     try:
         # Redirect stdout and stderr to /dev/null
@@ -135,7 +291,17 @@ def load_model_threaded_and_quietly(args, result_container):
         os.dup2(dev_null_fd, original_stderr_fd)
 
         mx.random.seed(args.seed)
-        model, tokenizer = load(args.model)
+        if args.weight_cache_dir:
+            cache_entry = weight_cache_entry(args.model, args.weight_cache_dir)
+            loaded = load_weight_cache(cache_entry) if cache_entry else None
+            if loaded:
+                model, tokenizer = loaded
+                cache_entry = None # Cache hit, nothing to write
+        if model is None:
+            model, tokenizer = load(args.model)
+            if args.weight_cache_dir and cache_entry is None:
+                # A Hub model downloaded just now can only be keyed once it is on disk
+                cache_entry = weight_cache_entry(args.model, args.weight_cache_dir)
 
     except Exception as e:
         error = e
@@ -159,6 +325,7 @@ def load_model_threaded_and_quietly(args, result_container):
     result_container['model'] = model
     result_container['tokenizer'] = tokenizer
     result_container['error'] = error
+    result_container['weight_cache_entry'] = cache_entry
 
 
 # --- ASCII Art Animation ---
@@ -176,59 +343,63 @@ THINKER_CHAT_ART = [
 # Define the spinning characters for the wipe
 WIPE_CHARS = ['|', '/', '-', '\\\\'] # Use double backslash for literal backslash
 
-def animate_ascii_art(art_lines, delay=0.0075, wipe_chars=WIPE_CHARS): # Reduced default delay
-    """Animates ASCII art by wiping it onto the screen with spinning characters."""
-    max_len = max(len(line) for line in art_lines) if art_lines else 0
-    height = len(art_lines)
-    if height == 0 or not wipe_chars:
-        return # Nothing to animate or no wipe characters
+# Art geometry, padded rows and the finished drawing, computed once at import.
+# The art is plain ASCII, so byte offsets and character offsets coincide.
+_ART_H = len(THINKER_CHAT_ART)
+_ART_W = max(map(len, THINKER_CHAT_ART))
+_ART_PADDED_BYTES = tuple(line.ljust(_ART_W).encode("utf-8") for line in THINKER_CHAT_ART)
+_ART_DRAWN_BYTES = b"".join(line + b"\n" for line in _ART_PADDED_BYTES)
+
+def animate_ascii_art(delay=0.0075, wipe_chars=WIPE_CHARS, no_anim=False): # Reduced default delay
+    """Animates THINKER_CHAT_ART by wiping it onto the screen with spinning characters.
+
+    With `no_anim`, the finished art is drawn straight away with no wipe or pause.
+    """
+    max_len = _ART_W
+    height = _ART_H
+    if no_anim:
+        write_raw(CURSOR_TO_HOME + _ART_DRAWN_BYTES)
+        print("-" * max_len)
+        print() # Add an empty line for spacing
+        return
+    if not wipe_chars:
+        return # No wipe characters
+
+    # Each frame is built from slices of the pre-padded rows
+    padded = _ART_PADDED_BYTES
+    wipe_bytes = [ch.encode("utf-8") for ch in wipe_chars]
 
     # Wipe effect - diagonal wipe with spinning characters
-    wipe_char_index = 0
     for i in range(max_len + height):
-        sys.stdout.write(CURSOR_TO_HOME) # Go to top-left for redraw
-        current_wipe_char = wipe_chars[wipe_char_index % len(wipe_chars)] # Cycle through wipe chars
+        current_wipe_char = wipe_bytes[i % len(wipe_bytes)] # Cycle through wipe chars
+        frame = bytearray(CURSOR_TO_HOME) # Go to top-left for redraw
         for r in range(height):
-            line_content = ""
-            current_line = art_lines[r]
-            for c in range(max_len):
-                # Calculate if the character at (r, c) should be revealed
-                # Use a diagonal condition (r + c) < i
-                if (c + r) < i:
-                    if c < len(current_line):
-                         line_content += current_line[c]
-                    else:
-                         line_content += " " # Pad shorter lines to max_len
-                else:
-                    # Draw the current wipe character if it's exactly on the boundary
-                    if (c + r) == i and c < max_len:
-                         line_content += current_wipe_char # Use the cycled character
-                    else:
-                         line_content += " " # Keep blank or padding
-
-            # Print the line, ensuring it clears previous content up to max_len
-            # Use print() instead of sys.stdout.write for automatic newline
-            print(line_content.ljust(max_len), flush=False) # Delay flush until after full frame
-
-        sys.stdout.flush() # Flush after drawing all lines for the frame
+            # Characters with (r + c) < i are revealed, the wipe char sits on the boundary
+            reveal = max(0, min(max_len, i - r))
+            frame += padded[r][:reveal]
+            if reveal < max_len and i - r >= 0:
+                frame += current_wipe_char
+                frame += b" " * (max_len - reveal - 1)
+            else:
+                frame += b" " * (max_len - reveal)
+            frame += b"\n"
+
+        # One write and flush per frame instead of one print per row
+        write_raw(frame)
         time.sleep(delay)
-        wipe_char_index += 1 # Move to next wipe character for the next frame
 
     # --- Clear the animation area using ANSI escape codes before final redraw ---
-    sys.stdout.write(CURSOR_TO_HOME) # Go to top-left
+    clear = bytearray(CURSOR_TO_HOME) # Go to top-left
     for r in range(height):
-        # Move cursor to beginning of line 'r' (1-indexed)
-        sys.stdout.write(f"[{r + 1};1H")
-        # Clear the entire line
-        sys.stdout.write("[2K")
-    sys.stdout.flush() # Ensure clearing commands are sent
+        # Move cursor to beginning of line 'r' (1-indexed), then clear the entire line
+        clear += b"\x1b[%d;1H" % (r + 1)
+        clear += CLEAR_LINE
     # --- End clearing logic ---
 
     # Final redraw of the art without the wipe character
-    sys.stdout.write(CURSOR_TO_HOME) # Ensure cursor is at home before drawing
-    for line in art_lines:
-        sys.stdout.write(line.ljust(max_len) + "\n")
-    sys.stdout.flush()
+    clear += CURSOR_TO_HOME # Ensure cursor is at home before drawing
+    clear += _ART_DRAWN_BYTES
+    write_raw(clear)
     # Add a small pause after the animation completes
     time.sleep(0.3)
     # Print a separator line below the art
@@ -236,6 +407,27 @@ def animate_ascii_art(art_lines, delay=0.0075, wipe_chars=WIPE_CHARS): # Reduced
     print() # Add an empty line for spacing
 
 
+def trim_history(history, tokenizer, excess):
+    """Drops the oldest user/assistant pairs until about `excess` tokens have been removed.
+
+    Each pair is sized by encoding its user message and the part of the reply after
+    </think>, which is what chat templates keep when re-rendering earlier turns. Template
+    overhead is not counted, so the real saving is at least the estimate. A leading system
+    message and the newest (pending) user message are always kept. Returns False if there
+    was nothing to drop.
+    """
+    start = 1 if history and history[0]["role"] == "system" else 0
+    end = start
+    removed = 0
+    while removed < excess and len(history) - end >= 3:
+        reply = history[end + 1]["content"]
+        visible_reply = reply[reply.rfind(THINK_END_TAG) + len(THINK_END_TAG):] if THINK_END_TAG in reply else reply
+        removed += len(tokenizer.encode(history[end]["content"])) + len(tokenizer.encode(visible_reply))
+        end += 2
+    del history[start:end]
+    return end > start
+
+
 def parse_args():
     """Parses command-line arguments."""
     parser = argparse.ArgumentParser(
@@ -268,6 +460,28 @@ def parse_args():
         default=DEFAULT_SEED,
         help="Seed for the pseudo-random number generator for reproducible results.",
     )
+    parser.add_argument(
+        "--context",
+        type=int,
+        default=DEFAULT_CONTEXT,
+        help="Token budget for the prompt plus --max-tokens of response. "
+             "The oldest turns are dropped from the history once it would be exceeded.",
+    )
+    parser.add_argument(
+        "--no-anim",
+        action="store_true",
+        default=os.environ.get("THINKER_CHAT_NO_ANIM", "") not in ("", "0"),
+        help="Skip the header animation at startup and on /clear (also set by THINKER_CHAT_NO_ANIM=1).",
+    )
+    parser.add_argument(
+        "--weight-cache-dir",
+        type=str,
+        default=None,
+        help="Directory for caching a self-contained copy of the loaded model between runs "
+             "(e.g. ~/.cache/thinker-chat). Helps most for Hub models (no Hub round-trip at startup) "
+             "and sharded or unconverted checkpoints; little gain for a local pre-converted MLX model. "
+             "Disabled when not set; each cached model takes roughly its full size on disk.",
+    )
     return parser.parse_args()
 
 def main_cli():
@@ -289,7 +503,7 @@ def main_cli():
 
     # --- Animated Header (runs while model loads in background) ---
     # The print statements that were here are moved to after model loading
-    animate_ascii_art(THINKER_CHAT_ART)
+    animate_ascii_art(no_anim=args.no_anim)
 
     # --- Wait for model loading to complete ---
     model_loader_thread.join() # Wait for the thread to finish
@@ -308,6 +522,14 @@ def main_cli():
         sys.stdout.flush()
         sys.exit(1) # Exit, atexit registered function will run
 
+    # --- Write the weight cache on a miss (in the foreground, so the wait is explained) ---
+    cache_entry = load_results.get('weight_cache_entry')
+    if cache_entry:
+        print(f"Writing weight cache to {cache_entry} (first run for this model)...")
+        sys.stdout.flush()
+        if not save_weight_cache(model, tokenizer.name_or_path, cache_entry):
+            print("Could not write the weight cache, continuing without it.")
+
     # --- Model loaded successfully. Now print initial operational messages ---
     # animate_ascii_art prints a separator and a newline, so these should appear after it.
     print("Enter 'q' or 'quit' to exit. Enter '/clear' to reset the chat.")
@@ -316,15 +538,28 @@ def main_cli():
     print("-" * 10)
     sys.stdout.flush() # Ensure these messages are displayed
 
-    # --- Delayed Imports for Chat Loop Functionality (after model loading) ---
+    # --- Delayed Imports for Chat Loop Functionality (already loaded by the loader thread) ---
     import mlx.core as mx # Needed for mx.array
-    from mlx_lm.generate import stream_generate
     from mlx_lm.sample_utils import make_sampler
+    from mlx_lm.models.cache import make_prompt_cache, can_trim_prompt_cache, trim_prompt_cache
+    from mlx_lm.utils import common_prefix_len
     # Note: mlx.nn is not directly used in the main loop but often related.
     # If other mx functionalities are added later, ensure their imports are also here or global.
 
     history = []
 
+    # KV cache reused across turns, plus the token ids it currently holds.
+    # Each turn only the tokens past the shared prefix are run through the model.
+    prompt_cache = make_prompt_cache(model)
+    prev_prompt_ids = []
+
+    # Build the sampler once per session; mlx_lm already compiles its categorical sampling
+    sampler = make_sampler(temp=args.temp) # Use default sampler settings for now
+
+    # One spinner for the whole session; start()/stop() are cheap and stop() is a no-op when idle
+    spinner = Spinner()
+    spinner_instance = spinner # Make it globally accessible for signal handler
+
     while True:
         try:
             prompt_text = input(">> ")
@@ -333,10 +568,11 @@ def main_cli():
             # --- Add /clear command ---
             if prompt_text.strip().lower() == "/clear":
                 history.clear() # Clear the chat history
+                prompt_cache = make_prompt_cache(model) # Drop the cached conversation state
+                prev_prompt_ids = []
                 # Clear screen, reset cursor, replay animation, print info
-                sys.stdout.write(CLEAR_SCREEN + CURSOR_TO_HOME)
-                sys.stdout.flush() # Ensure screen clears before animation
-                animate_ascii_art(THINKER_CHAT_ART)
+                write_raw(CLEAR_SCREEN + CURSOR_TO_HOME) # Ensure screen clears before animation
+                animate_ascii_art(no_anim=args.no_anim)
                 print("Enter 'q' or 'quit' to exit.")
                 print("Model:", args.model)
                 print(f"Max Tokens: {args.max_tokens}, Temp: {args.temp}, Seed: {args.seed}")
@@ -352,127 +588,114 @@ def main_cli():
 
         history.append({"role": "user", "content": prompt_text})
 
+        # Start the spinner first so templating/tokenizing a long history is covered too
+        spinner.start()
+
         try:
-            # Apply the chat template to format the history
-            full_prompt = tokenizer.apply_chat_template(
-                history,
-                tokenize=False,
-                add_generation_prompt=True # Essential for instruction-tuned models
-            )
+            # Apply the chat template to format the history. The budget is checked against
+            # the rendered prompt, since the template may shorten earlier turns (e.g. by
+            # dropping their <think> blocks). When this turn's response would not fit within
+            # --context, trim down to half the prompt budget in one go, so the trimmed
+            # history stays a stable, cacheable prefix for the next several turns.
+            prompt_budget = args.context - args.max_tokens
+            while True:
+                spinner.tick()
+                full_prompt = tokenizer.apply_chat_template(
+                    history,
+                    tokenize=False,
+                    add_generation_prompt=True # Essential for instruction-tuned models
+                )
+                new_prompt_ids = tokenizer.encode(full_prompt)
+                spinner.tick()
+                if len(new_prompt_ids) <= prompt_budget:
+                    break
+                if not trim_history(history, tokenizer, len(new_prompt_ids) - prompt_budget // 2):
+                    break
         except Exception as e:
+            spinner.stop()
             print(f"\nError applying chat template: {e}")
             print("The model might lack a configured chat template. Skipping this turn.")
             history.pop() # Remove the user message that caused the error
             continue
 
-        prompt = mx.array(tokenizer.encode(full_prompt))
-
-        spinner = Spinner()
-        spinner_instance = spinner # Make it globally accessible for signal handler
-        spinner.start()
-
-        state = "thinking" # Initial state: waiting for </think>
-        buffer = "" # Accumulates text during thinking and newline stripping
+        # Reuse the cached prefix. The chat template may re-render earlier turns
+        # (e.g. dropping old <think> blocks), so trim the cache back to the point
+        # where the token ids diverge, and always leave at least one token to process.
+        prefix_len = min(common_prefix_len(prev_prompt_ids, new_prompt_ids), len(new_prompt_ids) - 1)
+        if prefix_len < len(prev_prompt_ids):
+            if prefix_len > 0 and can_trim_prompt_cache(prompt_cache):
+                trim_prompt_cache(prompt_cache, len(prev_prompt_ids) - prefix_len)
+            else:
+                prompt_cache = make_prompt_cache(model)
+                prefix_len = 0
+        prompt = mx.array(new_prompt_ids[prefix_len:])
+        prev_prompt_ids = list(new_prompt_ids) # Cache will hold the full prompt after prefill
+
+        thinking = True # Phase 1: hide output until </think>, phase 2: pass text straight through
+        tail = "" # Trailing text of the thinking phase, just long enough to catch a split tag
         assistant_full_response_text = "" # Accumulate full text for history
         printed_something = False # Track if any output was actually printed
+        stream_writer = StreamWriter()
 
         try:
-            # Use stream_generate which yields decoded text chunks
-            sampler = make_sampler(temp=args.temp) # Use default sampler settings for now
-            # Pass max_tokens directly to stream_generate
-            generator = stream_generate(
-                model, tokenizer, prompt, sampler=sampler, max_tokens=args.max_tokens
+            # stream_text runs generate_step directly and only detokenizes in batches;
+            # every generated token id is recorded in prev_prompt_ids, matching the cache.
+            generator = stream_text(
+                model, tokenizer, prompt, prev_prompt_ids, sampler=sampler, logits_processors=None,
+                max_tokens=args.max_tokens, prompt_cache=prompt_cache,
+                prompt_progress_callback=lambda *_: spinner.tick() # Keep spinning through prefill
             )
 
-            # Iterate through decoded text chunks from stream_generate
-            # stream_generate handles the max_tokens limit internally.
-            # Removed the manual chunk_count check.
-            for response_chunk in generator:
-                # response_chunk.text contains the decoded text string for this step
+            # generate_step handles the max_tokens limit, stream_text stops at EOS
+            for chunk_text in generator:
                 # Replace potential decoding errors represented by REPLACEMENT_CHAR
-                token_text = response_chunk.text.replace(REPLACEMENT_CHAR, "?") # Basic handling
+                token_text = chunk_text.replace(REPLACEMENT_CHAR, "?") # Basic handling
                 assistant_full_response_text += token_text # Append chunk to full response for history
 
-                # --- State Machine for Response Handling (operates on decoded token_text chunks) ---
-                if state == "thinking":
-                    if token_text: # Only append if we got valid text
-                        buffer += token_text
-                    # Check if the closing tag is now present in the buffer
-                    if "</think>" in buffer:
+                if thinking:
+                    spinner.tick()
+                    # Only the tail needs scanning: anything older was already checked
+                    tail += token_text
+                    match = _THINK_END.search(tail)
+                    if match:
                         spinner.stop() # Found the tag, stop the spinner
-                        spinner_instance = None
-
-                        # Extract content appearing *after* the tag
-                        think_tag_end_index = buffer.find("</think>") + len("</think>")
-                        remainder = buffer[think_tag_end_index:]
-                        buffer = remainder # Put remainder back in buffer for next state
-                        state = "stripping_newlines"
-                        # Process the remainder immediately in the next state block
-                        token_text = "" # Clear token_text as its content is now in buffer for the next iteration
-
-                # Use elif for state transitions
-                elif state == "stripping_newlines":
-                     # Add the current token's text to the buffer if not processed above
-                     # The remainder from 'thinking' is already in buffer
-                     if token_text: # Add any new text from this chunk
-                          buffer += token_text
-
-                     # Check buffer for leading newlines to remove
-                     # This logic needs to handle partial chunks potentially splitting newlines
-                     while buffer and state == "stripping_newlines": # Process buffer content
-                         if buffer.startswith("\n\n"): # Check for double newline first
-                             buffer = buffer[2:] # Remove double newline
-                             # If something remains, print it and transition
-                             if buffer:
-                                 print(buffer, end="", flush=True)
-                                 printed_something = True
-                                 buffer = "" # Clear buffer after printing
-                                 state = "streaming"
-                             # If buffer became empty, stay in stripping, wait for more tokens
-                         elif buffer.startswith("\n"): # Check for single newline
-                             buffer = buffer[1:] # Remove single newline
-                             if buffer:
-                                 print(buffer, end="", flush=True)
-                                 printed_something = True
-                                 buffer = ""
-                                 state = "streaming"
-                         elif buffer: # Found non-newline content
-                             print(buffer, end="", flush=True)
-                             printed_something = True
-                             buffer = ""
-                             state = "streaming"
-                         else: # Buffer is empty or only contained newlines that were stripped
-                             break # Exit while loop, wait for next token_text
-
-                     token_text = "" # Clear token_text as its content was processed or is empty
-
-                elif state == "streaming":
-                    # Buffer should be empty, just print the current token's text
-                    if token_text:
-                        print(token_text, end="", flush=True)
-                        printed_something = True
+                        thinking = False
+                        # Content after the tag, minus the blank lines separating it from the answer
+                        token_text = tail[match.end():]
+                        tail = ""
+                    else:
+                        tail = tail[-(len(THINK_END_TAG) - 1):]
+                        continue
+
+                if not printed_something:
+                    # Newlines split into later chunks than the tag escape the regex
+                    token_text = token_text.lstrip("\n")
+                    if not token_text:
+                        continue
+                stream_writer.write(token_text)
+                printed_something = True
 
             # --- End of generation loop ---
-            spinner.stop() # Ensure spinner stops if max_tokens or EOS is reached (stream_generate handles EOS)
-            spinner_instance = None
+            stream_writer.drain()
+            spinner.stop() # Ensure spinner stops if max_tokens or EOS is reached
 
             # Use the accumulated text for history
             history.append({"role": "assistant", "content": assistant_full_response_text})
 
             if printed_something:
                 print() # Add a final newline
-            elif state == "thinking":
+            elif thinking:
                  print("\n[Model stopped before </think> tag or generated empty response]")
-            elif state == "stripping_newlines" and not buffer: # Check buffer state
+            else:
                  print("\n[Model stopped after </think> tag, ended with newlines]")
-            # If stopped while stripping and buffer has content (e.g. single \n), print it
-            elif state == "stripping_newlines" and buffer:
-                 print(buffer, end="\n") # Print remaining buffer content
 
 
         except Exception as e: # Catch errors during generation/streaming
+            stream_writer.drain()
             spinner.stop()
-            spinner_instance = None
+            # The cache may be partially updated; start fresh next turn
+            prompt_cache = make_prompt_cache(model)
+            prev_prompt_ids = []
             print(f"\nAn error occurred during generation: {e}")
             # Add a placeholder to history indicating the error
             history.append({"role": "assistant", "content": "[Error during generation]"})